@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the Qizx response parser backends.
+
+This code is part of the Qizx application components
+Copyright (c) 2015 Michael Paddon
+
+For conditions of use, see the accompanying license files.
+
+Synthetic eval (format=items) and getprop responses are decoded with each
+available parser backend. No server is required. Usage:
+
+    python benchmarks/parsers.py [--items N] [--paths N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+# run from a checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qizx
+import qizx.qizx
+
+
+def items_response(count):
+    """Build an items response of large element() items."""
+
+    item = ('<item type="element()"><record id="{0}">'
+            + '<field name="f{0}">value {0}</field>' * 50
+            + '</record></item>')
+    return ('<items>' + ''.join(item.format(i) for i in range(count))
+            + '</items>').encode("utf-8")
+
+
+def properties_response(count):
+    """Build a getprop response with a few properties per path."""
+
+    properties = ('<properties path="/c/doc{0}.xml">'
+                  '<property name="nature">document</property>'
+                  '<property name="size" type="integer">{0}</property>'
+                  '<property name="owner">user{0}</property>'
+                  '<property name="last-modified" type="dateTime">'
+                  '2015-08-05T10:00:00Z</property>'
+                  '</properties>')
+    return ('<result>' + ''.join(properties.format(i) for i in range(count))
+            + '</result>').encode("utf-8")
+
+
+def main(argv = sys.argv):
+    parser = argparse.ArgumentParser(prog = argv[0],
+        description = "Qizx response parser benchmark.")
+    parser.add_argument("--items", type = int, default = 2000,
+        help = "number of element items")
+    parser.add_argument("--paths", type = int, default = 20000,
+        help = "number of property paths")
+    parser.add_argument("--repeat", type = int, default = 5,
+        help = "repetitions (best time is reported)")
+    args = parser.parse_args(argv[1:])
+
+    items = items_response(args.items)
+    properties = properties_response(args.paths)
+    print("items: {0} bytes, properties: {1} bytes".format(
+        len(items), len(properties)))
+
+    for name in sorted(qizx.qizx._parsers):
+        client = qizx.Client("http://localhost/qizx/api", parser = name)
+
+        def decode_items():
+            return [client._decode_item(item)
+                for item in client._parser.elements(items, "item")]
+
+        def decode_properties():
+            return dict(client._decode_properties(p)
+                for p in client._parser.elements(properties, "properties"))
+
+        for label, function in (("items", decode_items),
+                ("properties", decode_properties)):
+            best = min(timeit.repeat(function,
+                repeat = args.repeat, number = 1))
+            print("{0:6} {1:11} {2:8.1f} ms".format(name, label, best * 1000))
+
+if __name__ == '__main__':
+    main()
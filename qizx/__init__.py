@@ -8,7 +8,11 @@ from .qizx import (
     Client, QizxError, QizxBadRequestError, QizxServerError,
     QizxNotFoundError, QizxAccessControlError, QizxXMLDataError,
     QizxCompilationError, QizxEvaluationError, QizxTimeoutError,
-    QizxImportError, UnexpectedResponseError, TransactionError
+    QizxResponseTooLargeError,
+    QizxImportError, UnexpectedResponseError, TransactionError,
+    Scheduler, ResponseCache, DiskCache, WriteBehindQueue, BatchSizer,
+    StatsSampler, StatsSample, JsonLinesExporter, WorkloadRecorder,
+    ShardedClient, Tracer, Span, PropertyMirror, Properties, PropertyTable
 )
 
 __title__ = 'qizx'
@@ -59,5 +59,7 @@ setup(
     packages=find_packages(exclude=['tests*']),
     package_data={'': ['LICENSE']},
     test_suite='tests',
-    install_requires=['isodate', 'requests', 'pyyaml'],
+    install_requires=['isodate', 'requests', 'pyyaml',
+        'futures; python_version < "3"'],
+    extras_require={'lxml': ['lxml']},
 )
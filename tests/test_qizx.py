@@ -7,7 +7,15 @@ Copyright (c) 2015 Michael Paddon
 For conditions of use, see the accompanying license files.
 """
 
+import email
+import io
+import json
+import os
 import qizx
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 
 
@@ -165,8 +173,936 @@ class ApiTest(unittest.TestCase):
     def test_19_listqueries(self):
         self._client.listqueries()
 
+    def test_20_eval_deadline(self):
+        with self.assertRaises(qizx.QizxTimeoutError):
+            self._client.eval("count(for $i in 1 to 1000000000 return $i)",
+                              library=self._library, deadline=0.5)
+
+    def test_21_putfiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = []
+            for i in range(5):
+                filename = os.path.join(directory, "doc{0}.xml".format(i))
+                with open(filename, "w") as f:
+                    f.write("<doc>{0}</doc>".format(i))
+                files.append(("/files/doc{0}.xml".format(i), filename))
+            documents, size = self._client.putfiles(
+                files, library=self._library, batch_count=2, jobs=2)
+            self.assertEqual(documents, 5)
+        finally:
+            shutil.rmtree(directory)
+        text = self._client.get("/files", library=self._library)
+        self.assertIn("/files/doc4.xml", text.splitlines())
+
+    def test_22_write_behind(self):
+        journal = tempfile.mkdtemp()
+        try:
+            queue = qizx.WriteBehindQueue(self._client, journal,
+                                          library=self._library,
+                                          max_memory=64, batch_count=2)
+            for i in range(5):
+                queue.put("/queued/doc{0}.xml".format(i),
+                          "<doc>{0}</doc>".format(i))
+            queue.close()
+            self.assertIsNone(queue.error)
+        finally:
+            shutil.rmtree(journal)
+        text = self._client.get("/queued", library=self._library)
+        self.assertIn("/queued/doc4.xml", text.splitlines())
+
+    def test_23_maintain(self):
+        results = self._client.maintain([self._library], "optimize", poll=1)
+        self.assertIsNone(results[self._library]["error"])
+        self.assertIsNotNone(results[self._library]["duration"])
+
+    def test_24_eval_many(self):
+        results = self._client.eval_many(["1 + 1", "(1, 2, 3)", "()",
+                                          "error()"],
+                                         library=self._library)
+        self.assertEqual(results[:3], [[2], [1, 2, 3], []])
+        self.assertIsInstance(results[3], qizx.QizxError)
+
+    def test_25_getprop_many(self):
+        paths = ["/test/hello.xml", "/files/doc0.xml", "/no/such.xml"]
+        properties = self._client.getprop_many(paths, ["nature"],
+                                               library=self._library,
+                                               chunk_size=1)
+        self.assertEqual(list(properties), paths[:2])
+
+    def test_26_eval_function(self):
+        self._client.register_module(
+            "math", 'module namespace m = "urn:test:math";\n'
+                    'declare function m:add($a, $b) { $a + $b };',
+            library=self._library)
+        self.assertEqual(self._client.eval_function("math", "add", (1, 2),
+                                                    format="items"), [3])
+
+    def test_27_max_response_bytes(self):
+        with self.assertRaises(qizx.QizxResponseTooLargeError):
+            self._client.eval("1 to 100000", max_response_bytes=1000)
+        with self._client.eval("<a/>", spool=True) as body:
+            self.assertIn(b"<a/>", body.read())
+
+    def test_28_walk(self):
+        documents = dict((collection, names) for collection, subcollections,
+                         names in self._client.walk(library=self._library,
+                                                    ttl=60))
+        self.assertIn("hello.xml", documents["/test"])
+        self.assertIn("doc0.xml", documents["/files"])
+
+    def test_29_property_mirror(self):
+        mirror = qizx.PropertyMirror(self._client, ":memory:", ["hello"],
+                                     library=self._library)
+        self.assertGreater(mirror.refresh(), 0)
+        self.assertEqual(mirror.get("/test/hello.xml")["hello"], "world")
+        self.assertIn("/test/hello.xml", mirror.filter("hello = ?",
+                                                       ("world",)))
+        mirror.refresh()
+        mirror.close()
+
     def test_99_dellib(self):
         self._client.dellib(self._library)
 
+
+class ParserTest(unittest.TestCase):
+    """Response parser backend unit tests (no server required)."""
+
+    _items = b'<items><item type="element()"><a><b/></a></item>' \
+             b'<item type="integer">3</item><item>x</item></items>'
+
+    def test_backends(self):
+        for parser in qizx.qizx._parsers:
+            client = qizx.Client("http://localhost/qizx/api", parser=parser)
+            items = [client._decode_item(item) for item in
+                     client._parser.iterparse(self._items, "item")]
+            self.assertEqual(items[0].tag, "a")
+            self.assertEqual(items[1:], [3, "x"])
+            client.close()
+
+    def test_foreign_elements(self):
+        elements = [qizx.qizx.xml.etree.ElementTree.fromstring(b"<m a='1'/>")]
+        if qizx.qizx.lxml is not None:
+            elements.append(qizx.qizx.lxml.etree.fromstring(b"<m a='1'/>"))
+        for parser in qizx.qizx._parsers.values():
+            for element in elements:
+                self.assertTrue(parser().iselement(element))
+                self.assertEqual(parser().tostring(element), '<m a="1" />'
+                                 if not hasattr(element, "getparent")
+                                 else '<m a="1"/>')
+            self.assertFalse(parser().iselement("<m/>"))
+
+    def test_import_errors(self):
+        client = qizx.Client("http://localhost/qizx/api")
+        errors = client._import_errors(
+            "IMPORT ERRORS 2\n/a.xml: not well-formed\n  at line 3\n"
+            "/a.xml2: lock timeout\n", ["/a.xml", "/a.xml2", "/b.xml"])
+        self.assertEqual(errors, [("/a.xml", "/a.xml: not well-formed\n"
+                                             "at line 3"),
+                                  ("/a.xml2", "/a.xml2: lock timeout")])
+        client.close()
+
+    def test_check_document(self):
+        path, content, error = qizx.qizx._check_document(
+            ("/a.xml", b"<a>\n  <b> x </b>\n</a>", True))
+        self.assertIsNone(error)
+        self.assertTrue(content.endswith(b"<a><b> x </b></a>"))
+        path, content, error = qizx.qizx._check_document(
+            ("/b.xml", b"<a><b></a>", False))
+        self.assertIsNone(content)
+        self.assertTrue(error.startswith("/b.xml: "))
+
+    def test_compact_properties(self):
+        client = qizx.Client("http://localhost/qizx/api")
+        content = b'<r><properties path="/a.xml">' \
+                  b'<property name="nature">document</property>' \
+                  b'<property name="size" type="integer">3</property>' \
+                  b'</properties><properties path="/b">' \
+                  b'<property name="nature">collection</property>' \
+                  b'</properties></r>'
+        table = client._decode_table(content, True)
+        self.assertEqual(list(table), ["/a.xml", "/b"])
+        self.assertEqual(table, client._decode_table(content, False))
+        self.assertEqual(table["/a.xml"]["size"], 3)
+        self.assertEqual(list(table["/b"].items()), [("nature", "collection")])
+        client.close()
+
+class ResponseCacheTest(unittest.TestCase):
+    """Response cache unit tests (no server required)."""
+
+    def test_eviction(self):
+        cache = qizx.ResponseCache(max_bytes=1000)
+        for i in range(5):
+            cache.store(("lib", "/c/{0}".format(i)),
+                        qizx.qizx._CacheEntry(b"x" * 200))
+        self.assertIsNone(cache.lookup(("lib", "/c/0")))
+        self.assertIsNotNone(cache.lookup(("lib", "/c/4")))
+
+    def test_invalidate(self):
+        cache = qizx.ResponseCache()
+        for path in ("/c", "/c/d", "/c/d/e.xml", "/f.xml"):
+            cache.store(("lib", path), qizx.qizx._CacheEntry(b"x"))
+        cache.invalidate("lib", "/c/d")
+        self.assertIsNotNone(cache.lookup(("lib", "/f.xml")))
+        for path in ("/c", "/c/d", "/c/d/e.xml"):
+            self.assertIsNone(cache.lookup(("lib", path)))
+
+    def test_trailing_slash(self):
+        client = qizx.Client("http://localhost/qizx/api#test",
+                             cache=qizx.ResponseCache())
+        client._session = _FakeSession(_FakeResponse("<c/>"),
+                                       _FakeResponse("/c"),
+                                       _FakeResponse("<c/>"))
+        client.get("/c/")
+        self.assertEqual(client.get("/c"), "<c/>")
+        self.assertEqual(len(client._session.requests), 1)
+        client.delete("/c")
+        self.assertEqual(client.get("/c/"), "<c/>")
+        self.assertEqual(len(client._session.requests), 3)
+
+class DiskCacheTest(unittest.TestCase):
+    """Disk cache unit tests (no server required)."""
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_roundtrip(self):
+        cache = qizx.DiskCache(self._directory)
+        cache.store(("lib", "/a.xml"),
+                    qizx.qizx._CacheEntry(b"<a/>", "utf-8", etag='"1"'))
+        entry = qizx.DiskCache(self._directory).lookup(("lib", "/a.xml"))
+        self.assertIsInstance(entry.content, memoryview)
+        self.assertEqual(entry.value(False), "<a/>")
+        self.assertEqual(entry.etag, '"1"')
+        cache.invalidate("lib", "/a.xml")
+        self.assertIsNone(cache.lookup(("lib", "/a.xml")))
+
+    def test_invalidate_descendants(self):
+        cache = qizx.DiskCache(self._directory)
+        paths = ("/", "/c", "/c/d", "/c/d/e.xml", "/c2/f.xml", "/g.xml")
+        for path in paths:
+            cache.store(("lib", path), qizx.qizx._CacheEntry(b"x"))
+        cache.store(("lib2", "/c/d"), qizx.qizx._CacheEntry(b"x"))
+        cache.invalidate("lib", "/c/d")
+        self.assertEqual([path for path in paths
+                          if cache.lookup(("lib", path)) is not None],
+                         ["/", "/c2/f.xml", "/g.xml"])
+        self.assertIsNotNone(cache.lookup(("lib2", "/c/d")))
+        cache.invalidate("lib", "/")
+        self.assertEqual([path for path in paths
+                          if cache.lookup(("lib", path)) is not None], [])
+        cache.store(("lib", "/c/d"), qizx.qizx._CacheEntry(b"y"))
+        self.assertEqual(cache.lookup(("lib", "/c/d")).value(True), b"y")
+        cache.clear()
+        self.assertIsNone(cache.lookup(("lib2", "/c/d")))
+
+class StatsSampleTest(unittest.TestCase):
+    """Statistics sample unit tests (no server required)."""
+
+    def test_rates(self):
+        first = qizx.StatsSample(100.0, {"queries": 10}, None)
+        second = qizx.StatsSample(102.0, {"queries": 30}, [], first)
+        self.assertEqual(second.deltas["queries"], 20)
+        self.assertEqual(second.rates["queries"], 10.0)
+        self.assertIn("qizx_queries_rate 10.0", second.to_prometheus())
+
+class WorkloadRecorderTest(unittest.TestCase):
+    """Workload recorder unit tests (no server required)."""
+
+    def test_fingerprint(self):
+        def record(query):
+            return {"op": "eval", "params": {"query": query}}
+        fingerprint = qizx.WorkloadRecorder.fingerprint
+        self.assertEqual(fingerprint(record('//a[@id="1"]')),
+                         fingerprint(record("//a[@id='x']")))
+        self.assertNotEqual(fingerprint(record("//a")),
+                            fingerprint(record("//b")))
+
+    def test_marked_queries(self):
+        output = io.StringIO()
+        client = qizx.Client("http://localhost/qizx/api#test",
+                             recorder=qizx.WorkloadRecorder(output))
+        client.client_timeout = 5
+        client._session = _FakeSession(*[_FakeResponse("1")] * 3)
+        for i in range(3):
+            client.eval("count(//a)")
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record["params"]["query"] for record in records],
+                         ["count(//a)"] * 3)
+        self.assertEqual(len(set(qizx.WorkloadRecorder.fingerprint(record)
+                                 for record in records)), 1)
+        self.assertEqual(qizx.WorkloadRecorder.fingerprint(
+            {"op": "eval", "params": {"query": "1 (: qizxpy-0a :)"}}),
+            qizx.WorkloadRecorder.fingerprint(
+                {"op": "eval", "params": {"query": "1 (: qizxpy-1b :)"}}))
+
+
+class ShardedClientTest(unittest.TestCase):
+    """Sharded client unit tests (no server required)."""
+
+    def test_ring(self):
+        url = "http://localhost:8080/qizx/api"
+        sharded = qizx.ShardedClient([(qizx.Client(url), "a"),
+                                      (qizx.Client(url), "b")])
+        paths = ["/doc{0}.xml".format(i) for i in range(200)]
+        before = [sharded.shard(path)[1] for path in paths]
+        self.assertEqual(set(before), set(["a", "b"]))
+        sharded.add_shard((qizx.Client(url), "c"))
+        after = [sharded.shard(path)[1] for path in paths]
+        for old, new in zip(before, after):
+            self.assertIn(new, (old, "c"))
+        self.assertIn("c", after)
+
+class TracerTest(unittest.TestCase):
+    """Tracer unit tests (no server required)."""
+
+    def test_nesting(self):
+        spans = []
+        tracer = qizx.Tracer(spans.append)
+        with tracer.span("eval", library="test") as outer:
+            tracer.record("parse", outer.start, 0.5, items=3)
+            outer.set(items=3)
+        with self.assertRaises(ValueError):
+            with tracer.span("eval"):
+                raise ValueError()
+        self.assertEqual([span.name for span in spans],
+                         ["parse", "eval", "eval"])
+        self.assertEqual(spans[0].parent, spans[1].id)
+        self.assertEqual(spans[0].trace, spans[1].trace)
+        self.assertIsNone(spans[1].parent)
+        self.assertEqual(spans[1].attributes, {"library": "test", "items": 3})
+        self.assertEqual(spans[2].attributes["error"], "ValueError")
+
+    def test_non_eval_calls(self):
+        spans = []
+        client = qizx.Client("http://localhost/qizx/api#test",
+                             tracer=qizx.Tracer(spans.append))
+        client._session = _FakeSession(
+            _FakeResponse('<r><properties path="/a.xml">'
+                          '<property name="nature">document</property>'
+                          '</properties></r>', "text/xml"),
+            _FakeResponse('{"records": [{"TaskName": "backup"}]}',
+                          "application/json"))
+        self.assertIn("/a.xml", client.getprop("/a.xml"))
+        self.assertEqual(client.listtasks(), [{"TaskName": "backup"}])
+        names = [span.name for span in spans]
+        self.assertEqual(names.count("parse"), 2)
+        self.assertEqual(names.count("decode"), 2)
+        self.assertEqual([span.attributes.get("items") for span in spans
+                          if span.name == "decode"], [1, 1])
+
+class BatchSizerTest(unittest.TestCase):
+    """Adaptive batch sizer unit tests (no server required)."""
+
+    def test_aimd(self):
+        sizer = qizx.BatchSizer(initial=100, step=10, target_latency=1)
+        sizer.observe(100, 1000000, 0.1)
+        self.assertEqual(sizer.size, 110)
+        sizer.observe(50, 1000000, 0.1)
+        self.assertEqual(sizer.size, 110)
+        sizer.observe(110, 0, 0.1, qizx.QizxServerError("Server: down"))
+        self.assertEqual(sizer.size, 55)
+        sizer.observe(55, 0, 0.1, qizx.QizxImportError("IMPORT ERRORS 1"))
+        self.assertEqual(sizer.size, 55)
+        sizer.observe(55, 1000000, 2)
+        self.assertEqual(sizer.size, 27)
+        self.assertEqual(sizer.metrics()["decreases"], 2)
+
+class MultipartBodyTest(unittest.TestCase):
+    """Streamed upload body unit tests (no server required)."""
+
+    def test_encoding(self):
+        readable = io.BytesIO(b"..<c/>")
+        readable.seek(2)
+        body = qizx.qizx._MultipartBody(
+            [("op", "put"), ("library", None)],
+            [("data", memoryview(b"<a/>")), ("data2", (readable, 4))])
+        content = b"".join(bytes(chunk) for chunk in body)
+        self.assertEqual(len(content), len(body))
+        message = email.message_from_bytes(
+            b"Content-Type: " + body.content_type.encode("ascii") +
+            b"\r\n\r\n" + content)
+        parts = [(part.get_param("name", header="content-disposition"),
+                  part.get_payload(decode=True))
+                 for part in message.get_payload()]
+        self.assertEqual(parts, [("op", b"put"), ("data", b"<a/>"),
+                                 ("data2", b"<c/>")])
+
+class _FakeResponse(object):
+    """Canned server response."""
+
+    def __init__(self, text, content_type="text/plain"):
+        self.headers = {"content-type": content_type}
+        self.content = text.encode("utf-8")
+        self.encoding = "utf-8"
+        self.status_code = 200
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding)
+
+    def raise_for_status(self):
+        pass
+
+
+class _FakeSession(object):
+    """Session recording requests and replying with canned responses."""
+
+    def __init__(self, *responses):
+        self.requests = []
+        self._responses = list(responses)
+
+    def _reply(self, kwargs):
+        data = kwargs.get("data")
+        if hasattr(data, "read"):
+            content = b"".join(bytes(chunk) for chunk in data)
+            assert len(content) == len(data), "wrong Content-Length"
+            message = email.message_from_bytes(
+                b"Content-Type: " +
+                kwargs["headers"]["Content-Type"].encode("ascii") +
+                b"\r\n\r\n" + content)
+            data = [(part.get_param("name", header="content-disposition"),
+                     part.get_payload(decode=True))
+                    for part in message.get_payload()]
+        self.requests.append((data, kwargs.get("files")))
+        return self._responses.pop(0)
+
+    def get(self, url, **kwargs):
+        return self._reply(kwargs)
+
+    def post(self, url, **kwargs):
+        return self._reply(kwargs)
+
+
+class UploadTest(unittest.TestCase):
+    """Document upload unit tests (no server required)."""
+
+    def _client(self, *responses):
+        client = qizx.Client("http://localhost/qizx/api#test")
+        client._session = _FakeSession(*responses)
+        return client
+
+    def test_retry_failed(self):
+        client = self._client(
+            _FakeResponse("IMPORT ERRORS 2\n/b.xml: lock timeout\n"
+                          "/c.xml: not well-formed\n"),
+            _FakeResponse("IMPORT ERRORS 0\n"))
+        quarantined = client.put([("/a.xml", "<a/>"),
+                                  ("/b.xml", io.BytesIO(b"<b/>")),
+                                  ("/c.xml", "<c")], retry_failed=1)
+        self.assertEqual(quarantined, [("/c.xml", "/c.xml: not well-formed")])
+        retried = client._session.requests[1][0]
+        self.assertIn(("path", b"/b.xml"), retried)
+        self.assertIn(("data", b"<b/>"), retried)
+        self.assertEqual(len(retried), 4)
+
+    def test_all_rejected(self):
+        client = self._client()
+        quarantined = client.put([("/a.xml", "<a")], retry_failed = 0,
+                                 validate = True)
+        self.assertEqual([path for path, error in quarantined], ["/a.xml"])
+        self.assertEqual(client._session.requests, [])
+
+    def test_multipart_parts(self):
+        client = self._client(_FakeResponse("IMPORT ERRORS 0\n"),
+                              _FakeResponse(""), _FakeResponse(""))
+        client.put([("/a.xml", u"<a>h\u00e9llo</a>")])
+        client.setindexing(io.StringIO(u"<indexing>\u00e9</indexing>"))
+        client.setindexing(u"<indexing>\u00e9</indexing>")
+        requests = client._session.requests
+        self.assertIn(("data", u"<a>h\u00e9llo</a>".encode("utf-8")),
+                      requests[0][0])
+        for data, files in requests[1:]:
+            self.assertIsNone(files)
+            self.assertIn(("indexing",
+                           u"<indexing>\u00e9</indexing>".encode("utf-8")),
+                          data)
+
+class _BlockingSession(_FakeSession):
+    """Session holding each request until released."""
+
+    def __init__(self, *responses):
+        _FakeSession.__init__(self, *responses)
+        self.release = threading.Event()
+        self.entered = 0
+
+    def _reply(self, kwargs):
+        self.entered += 1
+        assert self.release.wait(10), "request not released"
+        response = self._responses[0] if self._responses else None
+        if isinstance(response, Exception):
+            self._responses.pop(0)
+            self.requests.append((kwargs.get("params"), None))
+            raise response
+        return _FakeSession._reply(self, kwargs)
+
+
+class _CountingEvent(object):
+    """Event counting the threads waiting for it."""
+
+    def __init__(self, event):
+        self._event = event
+        self.waiting = 0
+
+    def wait(self, timeout=None):
+        self.waiting += 1
+        return self._event.wait(timeout)
+
+    def set(self):
+        self._event.set()
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Request coalescing unit tests (no server required)."""
+
+    def _client(self, *responses):
+        client = qizx.Client("http://localhost/qizx/api#test", coalesce=True)
+        client._session = _BlockingSession(*responses)
+        return client
+
+    def _concurrent(self, client, count, path="/a"):
+        # start count identical gets, the first holding the others
+        results = [None] * count
+
+        def get(index):
+            try:
+                results[index] = client.get(path)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=get, args=(index,))
+                   for index in range(count)]
+        threads[0].start()
+        self.assertTrue(_wait_for(lambda: client._session.entered == 1))
+        flight = list(client._flights._calls.values())[0]
+        flight.done = _CountingEvent(flight.done)
+        for thread in threads[1:]:
+            thread.start()
+        self.assertTrue(_wait_for(lambda: flight.done.waiting == count - 1))
+        client._session.release.set()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        return results
+
+    def test_identical(self):
+        client = self._client(_FakeResponse("<a/>"))
+        self.assertEqual(self._concurrent(client, 10), ["<a/>"] * 10)
+        self.assertEqual(len(client._session.requests), 1)
+
+    def test_different(self):
+        client = self._client(_FakeResponse("<a/>"), _FakeResponse("<b/>"))
+        results = {}
+        threads = [threading.Thread(target=lambda path: results.__setitem__(
+            path, client.get(path)), args=(path,)) for path in ("/a", "/b")]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(_wait_for(lambda: client._session.entered == 2))
+        client._session.release.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(sorted(results.values()), ["<a/>", "<b/>"])
+        self.assertEqual(len(client._session.requests), 2)
+
+    def test_error(self):
+        error = qizx.qizx.requests.exceptions.ConnectionError("down")
+        client = self._client(error)
+        results = self._concurrent(client, 5)
+        self.assertTrue(all(result is error for result in results))
+        self.assertEqual(len(client._session.requests), 1)
+
+    def test_released(self):
+        client = self._client(_FakeResponse("<a/>"), _FakeResponse("<a2/>"))
+        client._session.release.set()
+        self.assertEqual(client.get("/a"), "<a/>")
+        self.assertEqual(client._flights._calls, {})
+        self.assertEqual(client.get("/a"), "<a2/>")
+        self.assertEqual(len(client._session.requests), 2)
+
+
+class EvalTest(unittest.TestCase):
+    """Query evaluation unit tests (no server required)."""
+
+    def test_body_timeout(self):
+        class _StalledResponse(_FakeResponse):
+            def iter_content(self, size):
+                yield b"<a>"
+                raise qizx.qizx.requests.exceptions.ConnectionError(
+                    qizx.qizx.requests.packages.urllib3.exceptions
+                    .ReadTimeoutError(None, None, "read timed out"))
+
+            def close(self):
+                pass
+
+        client = qizx.Client("http://localhost/qizx/api#test")
+        client._session = _FakeSession(_StalledResponse(""))
+        cancelled = []
+        client._cancel_marked = cancelled.append
+        self.assertRaises(qizx.QizxTimeoutError, client.eval, "1",
+                          deadline = 1, spool = True)
+        query = dict(client._session.requests[0][0])["query"]
+        self.assertEqual(len(cancelled), 1)
+        self.assertIn(cancelled[0], query)
+
+
+    def test_too_large(self):
+        class _LargeResponse(_FakeResponse):
+            def iter_content(self, size):
+                while True:
+                    yield b"x" * size
+
+            def close(self):
+                pass
+
+        client = qizx.Client("http://localhost/qizx/api#test")
+        client._session = _FakeSession(_LargeResponse(""))
+        cancelled = []
+        client._cancel_marked = cancelled.append
+        self.assertRaises(qizx.QizxResponseTooLargeError, client.eval,
+                          "1 to 1000000", max_response_bytes=1000)
+        query = dict(client._session.requests[0][0])["query"]
+        self.assertEqual(len(cancelled), 1)
+        self.assertIn(cancelled[0], query)
+
+    def test_connect_timeout(self):
+        class _Session(_FakeSession):
+            def post(self, url, **kwargs):
+                raise qizx.qizx.requests.exceptions.ConnectTimeout()
+
+        client = qizx.Client("http://localhost/qizx/api#test")
+        client._session = _Session()
+        cancelled = []
+        client._cancel_marked = cancelled.append
+        self.assertRaises(qizx.qizx.requests.exceptions.ConnectionError,
+                          client.eval, "1", deadline = 1)
+        self.assertEqual(cancelled, [])
+
+
+class MaintainTest(unittest.TestCase):
+    """Maintenance task scheduling unit tests (no server required)."""
+
+    def test_busy_library(self):
+        client = qizx.Client("http://localhost/qizx/api#test")
+        tasks = [{"TaskName": "reindex", "Library": "a"}]
+        started = []
+        client.listtasks = lambda: list(tasks)
+        client.optimize = lambda library: started.append(library) or library
+
+        def progress(id):
+            del tasks[:]
+            return "optimize", 1
+
+        client.progress = progress
+        results = client.maintain(["a", "b"], "optimize", max_parallel = 2,
+                                  poll = 0)
+        self.assertEqual(started, ["b", "a"])
+        self.assertEqual([result["error"] for result in results.values()],
+                         [None, None])
+
+
+class WalkTest(unittest.TestCase):
+    """Collection walk unit tests (no server required)."""
+
+    def test_memo_bounded(self):
+        client = qizx.Client("http://localhost/qizx/api#test")
+        client._max_listings = 3
+        requests = []
+
+        def getprop(path, names, depth, library):
+            requests.append(path)
+            return {path: {"nature": "collection"}}
+
+        client.getprop = getprop
+        for path in ("/a", "/b", "/c", "/a", "/d"):
+            list(client.walk(path, ttl=60))
+        self.assertEqual(list(key[1] for key in client._listings),
+                         ["/c", "/a", "/d"])
+        list(client.walk("/b", ttl=60))
+        self.assertEqual(requests, ["/a", "/b", "/c", "/d", "/b"])
+
+
+class PropertyMirrorTest(unittest.TestCase):
+    """Property mirror unit tests (no server required)."""
+
+    def test_types(self):
+        client = qizx.Client("http://localhost/qizx/api#test",
+                             parser="etree")
+        properties = {
+            "flag": True,
+            "count": 3,
+            "ratio": 0.5,
+            "title": "hello",
+            "last-modified": qizx.qizx.isodate.parse_datetime(
+                "2015-06-01T12:00:00Z"),
+            "meta": client._parser.fromstring(b"<m a='1'/>")}
+        client.queryprop = lambda *args: {"/a.xml": properties}
+        mirror = qizx.PropertyMirror(client, ":memory:", list(properties))
+        mirror.refresh()
+        mirrored = mirror.get("/a.xml")
+        mirror.close()
+        for name, value in properties.items():
+            if name == "meta":
+                self.assertEqual(mirrored[name].tag, "m")
+                self.assertEqual(mirrored[name].get("a"), "1")
+            else:
+                self.assertEqual(mirrored[name], value)
+                self.assertIs(type(mirrored[name]), type(value))
+
+    def test_watermark(self):
+        client = qizx.Client("http://localhost/qizx/api#test")
+        parse = qizx.qizx.isodate.parse_datetime
+        client.queryprop = lambda *args: {
+            "/a.xml": {"last-modified": parse("2015-06-01T12:00:00+02:00")},
+            "/b.xml": {"last-modified": parse("2015-06-01T11:00:00Z")}}
+        mirror = qizx.PropertyMirror(client, ":memory:", [])
+        mirror.refresh()
+        self.assertEqual(mirror._meta("watermark"),
+                         "2015-06-01T11:00:00+00:00")
+        mirror.close()
+
+    def test_schema_change(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "mirror.db")
+            client = qizx.Client("http://localhost/qizx/api#test")
+            client.queryprop = lambda *args: {"/a.xml": {"title": "a"}}
+            mirror = qizx.PropertyMirror(client, filename, ["title"])
+            mirror.refresh()
+            mirror.close()
+            client.queryprop = lambda *args: {"/a.xml": {"owner": "me"}}
+            mirror = qizx.PropertyMirror(client, filename, ["owner"])
+            self.assertIsNone(mirror.age())
+            self.assertIsNone(mirror.get("/a.xml"))
+            mirror.refresh()
+            self.assertEqual(mirror.get("/a.xml"), {"owner": "me"})
+            mirror.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class SchemaTest(unittest.TestCase):
+    """Property schema unit tests (no server required)."""
+
+    def test_bounded(self):
+        schema = qizx.qizx._Schema
+        shared = schema.get(("a", "b"))
+        for i in range(schema._max_schemas * 2):
+            schema.get(("a", "b"))
+            schema.get(("n{0}".format(i),))
+        self.assertLessEqual(len(schema._schemas), schema._max_schemas)
+        self.assertIs(schema.get(("a", "b")), shared)
+
+
+class _PathSession(_FakeSession):
+    """Session answering gets with a document named after the path."""
+
+    def _reply(self, kwargs):
+        path = kwargs["params"]["path"]
+        self.requests.append((kwargs.get("params"), None))
+        if path == "/missing":
+            raise qizx.qizx.requests.exceptions.ConnectionError("refused")
+        return _FakeResponse("<{0}/>".format(path.strip("/")))
+
+
+class BatchTest(unittest.TestCase):
+    """Command line batch unit tests (no server required)."""
+
+    def setUp(self):
+        self._client = qizx.Client("http://localhost/qizx/api#test")
+        self._client._session = _PathSession()
+        self._factory = qizx.qizx.Client
+        qizx.qizx.Client = lambda url: self._client
+        self._streams = sys.stdout, sys.stderr
+        sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+        sys.stderr = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+        fd, self._file = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        qizx.qizx.Client = self._factory
+        sys.stdout, sys.stderr = self._streams
+        os.remove(self._file)
+
+    def _batch(self, lines, jobs=1):
+        with open(self._file, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        try:
+            qizx.qizx.main(["qizxpy", "batch", "--jobs", str(jobs),
+                            "-f", self._file])
+            status = 0
+        except SystemExit as e:
+            status = e.code
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return (status, sys.stdout.buffer.getvalue().decode("utf-8"),
+                sys.stderr.buffer.getvalue().decode("utf-8").splitlines())
+
+    def test_ordered_output(self):
+        status, output, errors = self._batch(
+            ["get /d{0}".format(i) for i in range(20)], jobs=8)
+        self.assertEqual(status, 0)
+        self.assertEqual(output, "".join("<d{0}/>".format(i)
+                                         for i in range(20)))
+        self.assertEqual(errors[-1].split(",")[:2],
+                         ["20 commands", " 0 failed"])
+
+    def test_errors(self):
+        status, output, errors = self._batch([
+            "get /a",
+            "get /missing",
+            "--url http://elsewhere/api get /b",
+            "top",
+            "nosuchcommand",
+            "get /c"])
+        self.assertEqual(status, 1)
+        self.assertEqual(output, "<a/><c/>")
+        reports = [line for line in errors if line.startswith("[")]
+        self.assertEqual([report.split()[1] for report in reports],
+                         ["OK", "ConnectionError:", "--url", "top",
+                          "exit", "OK"])
+        self.assertEqual(errors[-1].split(",")[1], " 4 failed")
+        self.assertEqual([params["path"] for params, files
+                          in self._client._session.requests],
+                         ["/a", "/missing", "/c"])
+
+    def test_mput_glob(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name in ("c.xml", "e/g.xml", "e/f/h.xml"):
+                path = os.path.join(root, "d", *name.split("/"))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "w") as f:
+                    f.write("<x/>")
+            stored = []
+            def putfiles(files, *args, **kwargs):
+                stored.extend(files)
+                return len(files), 0
+            self._client.putfiles = putfiles
+            pattern = os.path.join(root, "d", "**")
+            qizx.qizx.main(["qizxpy", "mput", pattern])
+            sys.stderr.flush()
+            errors = sys.stderr.buffer.getvalue().decode("utf-8")
+            self.assertNotIn("skipping directory", errors)
+            self.assertEqual([path for path, filename in stored],
+                             ["/c.xml", "/e/f/h.xml", "/e/g.xml"])
+        finally:
+            shutil.rmtree(root)
+
+
+class _FakeClient(object):
+    """Client whose put() raises queued errors, then records documents."""
+
+    def __init__(self, *errors):
+        self.stored = []
+        self._errors = list(errors)
+
+    def put(self, documents, xml = True, library = None):
+        if self._errors:
+            raise self._errors.pop(0)
+        self.stored.extend(documents)
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    """Write-behind queue unit tests (no server required)."""
+
+    def setUp(self):
+        self._journal = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._journal)
+
+    def test_retry(self):
+        client = _FakeClient(qizx.QizxServerError(500, "down"))
+        queue = qizx.WriteBehindQueue(client, self._journal,
+            retry_delay = 0.01)
+        queue.put("/a.xml", "<a/>")
+        self.assertTrue(queue.flush(timeout = 10))
+        queue.close()
+        self.assertEqual(client.stored, [("/a.xml", b"<a/>")])
+        self.assertIsNone(queue.error)
+
+    def test_close_while_retrying(self):
+        client = _FakeClient(*[qizx.QizxServerError(500, "down")] * 1000)
+        queue = qizx.WriteBehindQueue(client, self._journal,
+            retry_delay = 0.01)
+        queue.put("/a.xml", "<a/>")
+        queue.close(wait = False)
+        self.assertEqual([name for name in os.listdir(self._journal)
+                          if name.endswith(".batch")], ["000000000000.batch"])
+
+    def test_corrupt_journal(self):
+        with open(os.path.join(self._journal, "000000000000.batch"),
+                  "wb") as f:
+            f.write(b"garbage\n")
+        client = _FakeClient()
+        queue = qizx.WriteBehindQueue(client, self._journal)
+        self.assertTrue(queue.flush(timeout = 10))
+        queue.put("/a.xml", "<a/>")
+        self.assertTrue(queue.flush(timeout = 10))
+        queue.close()
+        self.assertIsInstance(queue.error, ValueError)
+        self.assertEqual(client.stored, [("/a.xml", b"<a/>")])
+        self.assertEqual(os.listdir(os.path.join(self._journal, "failed")),
+                         ["000000000000.batch"])
+
+
+def _wait_for(condition, timeout=10):
+    """Wait until a condition holds, returning False on timeout."""
+
+    idle = threading.Event()
+    for attempt in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        idle.wait(0.01)
+    return condition()
+
+
+class SchedulerTest(unittest.TestCase):
+    """Request scheduler unit tests (no server required)."""
+
+    def test_priority(self):
+        scheduler = qizx.Scheduler(total=1)
+        order = []
+
+        def request(op):
+            with scheduler.slot(op):
+                order.append(op)
+
+        with scheduler.slot("put"):
+            threads = [threading.Thread(target=request, args=(op,))
+                       for op in ("put", "delete", "eval")]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(_wait_for(lambda: sum(m["queued"]
+                for m in scheduler.metrics().values()) == 3))
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(order[0], "eval")
+        self.assertEqual(scheduler.metrics()["bulk"]["completed"], 3)
+
+    def test_streamed_body(self):
+        scheduler = qizx.Scheduler(total=1)
+        active = []
+
+        class _StreamedResponse(_FakeResponse):
+            def iter_content(self, size):
+                active.append(scheduler.metrics()["interactive"]["active"])
+                yield b"<a/>"
+
+            def close(self):
+                pass
+
+        client = qizx.Client("http://localhost/qizx/api#test",
+                             scheduler=scheduler)
+        client._session = _FakeSession(_StreamedResponse(""))
+        self.assertEqual(client.eval("<a/>", max_response_bytes=100), "<a/>")
+        self.assertEqual(active, [1])
+        self.assertEqual(scheduler.metrics()["interactive"]["active"], 0)
+
 if __name__ == '__main__':
     unittest.main()